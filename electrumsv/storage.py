@@ -33,6 +33,13 @@ import json
 import os
 import re
 import shutil
+try:
+    # Linux expects the latest package version of 3.31.1 (as of p)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS expects the latest brew version of 3.32.1 (as of 2020-07-10).
+    # Windows builds use the official Python 3.7.8 builds and version of 3.31.1.
+    import sqlite3 # type: ignore
 import stat
 import threading
 import time
@@ -55,8 +62,9 @@ from .logs import logs
 from .networks import Net
 from .transaction import Transaction, classify_tx_output, parse_script_sig
 from .wallet_database import (AccountTable, TxData, DatabaseContext, migration,
-    KeyInstanceTable, MasterKeyTable, PaymentRequestTable, TransactionDeltaTable,
-    TransactionOutputTable, TransactionTable, WalletDataTable)
+    MigrationDatabaseContext, KeyInstanceTable, MasterKeyTable, PaymentRequestTable,
+    SynchronousWriter, TransactionDeltaTable, TransactionOutputTable, TransactionTable,
+    WalletDataTable)
 from .wallet_database.tables import (AccountRow, KeyInstanceRow, MasterKeyRow,
     PaymentRequestRow, TransactionDeltaRow, TransactionOutputRow, TransactionRow,
     WalletDataRow)
@@ -805,7 +813,7 @@ class TextStore(AbstractStore):
         # Take the old style JSON data and add it to the latest database structure.
         # This code should be updated as the structure and wallet workings changes to ensure
         # older wallets can always be migrated as long as we support them.
-        db_context = DatabaseContext(self._path)
+        db_context = MigrationDatabaseContext(self._path)
         walletdata_table: Optional[WalletDataTable] = None
         try:
             walletdata_table = WalletDataTable(db_context)
@@ -870,7 +878,8 @@ class TextStore(AbstractStore):
             address_states: Dict[str, _AddressState] = {}
             tx_states: Dict[str, _TxState] = {}
 
-            date_added = int(time.time())
+            # All the rows created by the migration share the one creation timestamp.
+            date_created = int(time.time())
             for tx_id, tx_hex in tx_map_in.items():
                 tx_hash = hex_str_to_hash(tx_id)
                 tx_bytedata = bytes.fromhex(tx_hex)
@@ -891,7 +900,7 @@ class TextStore(AbstractStore):
                         verified=False, height=height, known_addresses=set([]),
                         encountered_addresses=set([]))
                 tx_metadata = TxData(height=height, fee=fee, position=position,
-                    date_added=date_added, date_updated=date_added)
+                    date_added=date_created, date_updated=date_created)
                 # TODO(rt12) BACKLOG what if this code is later reused and the operation is an
                 # import and the rows already exist?
                 transaction_rows.append(TransactionRow(tx_hash, tx_metadata, tx_bytedata, flags,
@@ -1157,7 +1166,7 @@ class TextStore(AbstractStore):
                     address_state.keyinstance_id,
                     request_data.get('status', 2), # PaymentFlag.UNKNOWN = 2
                     request_data.get('amount', None), request_data.get('exp', None),
-                    request_data.get('memo', None), request_data.get('time', time.time())))
+                    request_data.get('memo', None), request_data.get('time', date_created)))
                 next_paymentrequest_id += 1
 
             # Reconcile what addresses we found for transactions with the addresses that were in
@@ -1172,31 +1181,6 @@ class TextStore(AbstractStore):
                     logger.debug("db-migration, tx %s extra addresses %s", tx_id,
                         extra_addresses)
 
-            # Commit all the changes to the database. This is ordered to respect FK constraints.
-            # TODO(rt12) BACKLOG Shouldn't this use explicit creation calls for the first
-            # migration so that subsequent migrations can be applied?
-            if len(transaction_rows):
-                with TransactionTable(db_context) as table:
-                    table.create(transaction_rows)
-            if len(masterkey_rows):
-                with MasterKeyTable(db_context) as table:
-                    table.create(masterkey_rows)
-            if len(account_rows):
-                with AccountTable(db_context) as table:
-                    table.create(account_rows)
-            if len(keyinstance_rows):
-                with KeyInstanceTable(db_context) as table:
-                    table.create(keyinstance_rows)
-            if len(txdelta_rows):
-                with TransactionDeltaTable(db_context) as table:
-                    table.create(txdelta_rows)
-            if len(txoutput_rows):
-                with TransactionOutputTable(db_context) as table:
-                    table.create(txoutput_rows)
-            if len(paymentrequest_rows):
-                with PaymentRequestTable(db_context) as table:
-                    table.create(paymentrequest_rows)
-
             # The database creation should create these rows.
             creation_rows = []
             creation_rows.append(WalletDataRow("password-token",
@@ -1212,16 +1196,62 @@ class TextStore(AbstractStore):
                 value = self.get(key)
                 if value is not None:
                     creation_rows.append(WalletDataRow(key, value))
-            walletdata_table.create(creation_rows)
-
-            walletdata_table.update([
-                WalletDataRow("next_masterkey_id", next_masterkey_id),
-                WalletDataRow("next_account_id", next_account_id),
-                WalletDataRow("next_keyinstance_id", next_keyinstance_id),
-                WalletDataRow("next_paymentrequest_id", next_paymentrequest_id),
-            ])
+
+            # The indexes on the larger tables are built once after the rows are inserted, rather
+            # than updated per row. If the write fails, the rollback also restores the indexes.
+            index_sqls: List[str] = []
+            def _drop_indexes(db: sqlite3.Connection) -> None:
+                index_sqls[:] = migration.drop_indexes(db, [ "Transactions", "KeyInstances",
+                    "TransactionDeltas", "TransactionOutputs" ])
+
+            def _create_indexes(db: sqlite3.Connection) -> None:
+                migration.create_indexes(db, index_sqls)
+
+            # Commit all the changes to the database. This is ordered to respect FK constraints.
+            # The writes are grouped so that they are applied by the writer thread in one
+            # transaction, and we block until that succeeds.
+            # TODO(rt12) BACKLOG Shouldn't this use explicit creation calls for the first
+            # migration so that subsequent migrations can be applied?
+            with SynchronousWriter() as writer:
+                with db_context.write_group(writer.get_callback()):
+                    db_context.queue_write(_drop_indexes)
+                    if len(transaction_rows):
+                        with TransactionTable(db_context) as transaction_table:
+                            transaction_table.create(transaction_rows)
+                    if len(masterkey_rows):
+                        with MasterKeyTable(db_context) as masterkey_table:
+                            masterkey_table.create(masterkey_rows, date_created=date_created)
+                    if len(account_rows):
+                        with AccountTable(db_context) as account_table:
+                            account_table.create(account_rows, date_created=date_created)
+                    if len(keyinstance_rows):
+                        with KeyInstanceTable(db_context) as keyinstance_table:
+                            keyinstance_table.create(keyinstance_rows, date_created=date_created)
+                    if len(txdelta_rows):
+                        with TransactionDeltaTable(db_context) as txdelta_table:
+                            txdelta_table.create(txdelta_rows, date_created=date_created)
+                    if len(txoutput_rows):
+                        with TransactionOutputTable(db_context) as txoutput_table:
+                            txoutput_table.create(txoutput_rows, date_created=date_created)
+                    if len(paymentrequest_rows):
+                        with PaymentRequestTable(db_context) as paymentrequest_table:
+                            paymentrequest_table.create(paymentrequest_rows)
+
+                    walletdata_table.create(creation_rows, date_created=date_created)
+                    walletdata_table.update([
+                        WalletDataRow("next_masterkey_id", next_masterkey_id),
+                        WalletDataRow("next_account_id", next_account_id),
+                        WalletDataRow("next_keyinstance_id", next_keyinstance_id),
+                        WalletDataRow("next_paymentrequest_id", next_paymentrequest_id),
+                    ], date_updated=date_created)
+                    db_context.queue_write(_create_indexes)
+                assert writer.succeeded()
+
             walletdata_table.close()
             walletdata_table = None
+
+            # The migration writes were not synced, and the TEXT file is removed below.
+            db_context.sync_to_disk()
         finally:
             # We need to close this one explicitly if it opened successfully.
             if walletdata_table is not None:
@@ -11,20 +11,23 @@ except ModuleNotFoundError:
     # Windows builds use the official Python 3.7.8 builds and version of 3.31.1.
     import sqlite3 # type: ignore
 import tempfile
+import threading
 from typing import List
 
 from electrumsv.constants import (TxFlags, ScriptType, DerivationType, TransactionOutputFlag,
     PaymentFlag, KeyInstanceFlag, WalletEventFlag, WalletEventType)
 from electrumsv.logs import logs
 from electrumsv.types import TxoKeyType
+from electrumsv.wallet_database import tables
 from electrumsv.wallet_database import (migration, KeyInstanceTable, MasterKeyTable,
     PaymentRequestTable, TransactionTable, DatabaseContext, TransactionDeltaTable,
     TransactionOutputTable, SynchronousWriter, TxData, TxProof, AccountTable)
-from electrumsv.wallet_database.sqlite_support import LeakedSQLiteConnectionError
-from electrumsv.wallet_database.tables import (AccountRow, InvoiceAccountRow, InvoiceRow,
-    InvoiceTable, KeyInstanceRow, MAGIC_UNTOUCHED_BYTEDATA, MasterKeyRow, PaymentRequestRow,
-    TransactionDeltaRow, TransactionDeltaKeySummaryRow, TransactionRow, TransactionOutputRow,
-    WalletEventTable, WalletEventRow)
+from electrumsv.wallet_database.sqlite_support import (LeakedSQLiteConnectionError,
+    MigrationDatabaseContext)
+from electrumsv.wallet_database.tables import (AccountRow, batched, InvoiceAccountRow,
+    InvoiceRow, InvoiceTable, KeyInstanceRow, MAGIC_UNTOUCHED_BYTEDATA, MasterKeyRow,
+    MULTIROW_INSERT_LIMIT, PaymentRequestRow, TransactionDeltaRow, TransactionDeltaKeySummaryRow,
+    TransactionRow, TransactionOutputRow, WalletEventTable, WalletEventRow)
 
 
 logs.set_level("debug")
@@ -58,12 +61,42 @@ def db_context() -> None:
     value.close()
 
 
+@pytest.mark.parametrize("length,batch_size,batch_lengths", [
+    (0, 3, []), (2, 3, [2]), (3, 3, [3]), (7, 3, [3, 3, 1]) ])
+def test_batched(length: int, batch_size: int, batch_lengths: List[int]) -> None:
+    batches = list(batched((i for i in range(length)), batch_size))
+    assert [ len(batch) for batch in batches ] == batch_lengths
+    assert [ i for batch in batches for i in batch ] == list(range(length))
+
+
 def test_migrations() -> None:
     # Do all the migrations apply cleanly?
     wallet_path = os.path.join(tempfile.mkdtemp(), "wallet_create")
     migration.create_database_file(wallet_path)
 
 
+def test_migration_drop_and_create_indexes() -> None:
+    wallet_path = os.path.join(tempfile.mkdtemp(), "wallet_create")
+    migration.create_database_file(wallet_path)
+    db = sqlite3.connect(wallet_path + ".sqlite")
+    try:
+        def _read_index_names() -> List[str]:
+            return sorted(row[0] for row in db.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"))
+
+        index_names = _read_index_names()
+        assert "idx_TransactionOutputs_unique" in index_names
+
+        index_sqls = migration.drop_indexes(db, [ "TransactionOutputs" ])
+        assert len(index_sqls) == 1
+        assert "idx_TransactionOutputs_unique" not in _read_index_names()
+
+        migration.create_indexes(db, index_sqls)
+        assert index_names == _read_index_names()
+    finally:
+        db.close()
+
+
 @pytest.mark.timeout(8)
 def test_database_context() -> None:
     db_context = _db_context()
@@ -97,6 +130,124 @@ def test_database_context() -> None:
         conn.commit()
 
 
+@pytest.mark.timeout(8)
+def test_migration_database_context() -> None:
+    wallet_path = os.path.join(tempfile.mkdtemp(), "wallet_create")
+    migration.create_database_file(wallet_path)
+    db_context = MigrationDatabaseContext(wallet_path)
+    try:
+        conn = db_context.acquire_connection()
+        try:
+            # synchronous=OFF
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 0
+            # temp_store=MEMORY
+            assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+            assert conn.execute("PRAGMA cache_size").fetchone()[0] == -65536
+        finally:
+            db_context.release_connection(conn)
+    finally:
+        db_context.close()
+
+
+@pytest.mark.timeout(8)
+def test_migration_database_context_sync_to_disk() -> None:
+    wallet_path = os.path.join(tempfile.mkdtemp(), "wallet_create")
+    migration.create_database_file(wallet_path)
+    db_context = MigrationDatabaseContext(wallet_path)
+    try:
+        with MasterKeyTable(db_context) as table:
+            with SynchronousWriter() as writer:
+                table.create([ MasterKeyRow(1, None, 2, b'111') ],
+                    completion_callback=writer.get_callback())
+                assert writer.succeeded()
+
+        db_context.sync_to_disk()
+
+        conn = db_context.acquire_connection()
+        try:
+            # All the frames in the write-ahead log have been copied into the database file.
+            busy, log_frames, checkpointed_frames = conn.execute(
+                "PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            assert busy == 0
+            assert log_frames == checkpointed_frames
+            # The pooled connections all keep the migration setting of synchronous=OFF.
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 0
+        finally:
+            db_context.release_connection(conn)
+    finally:
+        db_context.close()
+
+
+@pytest.mark.timeout(8)
+def test_database_context_write_group(db_context: DatabaseContext) -> None:
+    masterkey_table = MasterKeyTable(db_context)
+    account_table = AccountTable(db_context)
+    try:
+        line1 = MasterKeyRow(1, None, 2, b'111')
+        line2 = AccountRow(1, 1, ScriptType.P2PKH, 'name1')
+
+        # The writes are discarded if the group exits with an exception, and their completion
+        # callbacks are given that exception.
+        with SynchronousWriter() as writer:
+            with pytest.raises(ValueError):
+                with db_context.write_group():
+                    masterkey_table.create([ line1 ], completion_callback=writer.get_callback())
+                    raise ValueError()
+            with pytest.raises(ValueError):
+                writer.succeeded()
+        assert [] == masterkey_table.read()
+
+        with SynchronousWriter() as writer:
+            with db_context.write_group(writer.get_callback()):
+                masterkey_table.create([ line1 ])
+                account_table.create([ line2 ])
+            assert writer.succeeded()
+
+        assert [ line1 ] == masterkey_table.read()
+        assert [ line2 ] == account_table.read()
+
+        # A failed write rolls back the whole group.
+        with pytest.raises(sqlite3.IntegrityError):
+            with SynchronousWriter() as writer:
+                with db_context.write_group(writer.get_callback()):
+                    masterkey_table.create([ MasterKeyRow(2, None, 2, b'222') ])
+                    account_table.create([ line2 ])
+                writer.succeeded()
+
+        assert [ line1 ] == masterkey_table.read()
+    finally:
+        masterkey_table.close()
+        account_table.close()
+
+
+@pytest.mark.timeout(8)
+def test_database_context_write_group_threads(db_context: DatabaseContext) -> None:
+    masterkey_table = MasterKeyTable(db_context)
+    try:
+        lines = [ MasterKeyRow(i, None, 2, b'111') for i in range(1, 3) ]
+        # Both threads are inside their own write group at the same time.
+        barrier = threading.Barrier(len(lines))
+        results: List[bool] = []
+
+        def _create(line: MasterKeyRow) -> None:
+            with SynchronousWriter() as writer:
+                with db_context.write_group(writer.get_callback()):
+                    barrier.wait()
+                    masterkey_table.create([ line ])
+                results.append(writer.succeeded())
+
+        threads = [ threading.Thread(target=_create, args=(line,)) for line in lines ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert [ True, True ] == results
+        assert lines == sorted(masterkey_table.read())
+    finally:
+        masterkey_table.close()
+
+
 @pytest.mark.timeout(8)
 def test_table_masterkeys_crud(db_context: DatabaseContext) -> None:
     table = MasterKeyTable(db_context)
@@ -231,6 +382,88 @@ def test_table_accounts_crud(db_context: DatabaseContext) -> None:
     table.close()
 
 
+@pytest.mark.timeout(8)
+def test_table_accounts_create_many(db_context: DatabaseContext) -> None:
+    # This exceeds the number of rows inserted by each multi-row statement.
+    lines = [ AccountRow(i, None, ScriptType.P2PKH, f'name{i}')
+        for i in range(1, MULTIROW_INSERT_LIMIT + 2) ]
+    with AccountTable(db_context) as table:
+        with SynchronousWriter() as writer:
+            table.create(lines, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        assert lines == sorted(table.read())
+
+
+@pytest.mark.timeout(8)
+def test_table_create_many_batches(db_context: DatabaseContext, monkeypatch) -> None:
+    # Each of these creates is written in several batches, the last of them partial.
+    monkeypatch.setattr(tables, "WRITE_BATCH_SIZE", 2)
+    COUNT = 5
+    ACCOUNT_ID = 10
+    MASTERKEY_ID = 20
+
+    tx_bytes = [ os.urandom(10) for i in range(COUNT) ]
+    tx_hashes = [ bitcoinx.double_sha256(tx_data) for tx_data in tx_bytes ]
+    tx_lines = [ TransactionRow(tx_hash, TxData(height=1, fee=2, position=None, date_added=1,
+        date_updated=1), tx_data, TxFlags.HasByteData|TxFlags.HasFee|TxFlags.HasHeight, None)
+        for tx_hash, tx_data in zip(tx_hashes, tx_bytes) ]
+    key_lines = [ KeyInstanceRow(i, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32, b'111',
+        ScriptType.P2PKH, KeyInstanceFlag.IS_ACTIVE, None) for i in range(1, COUNT+1) ]
+    txo_lines = [ TransactionOutputRow(tx_hash, 0, 100, i, 0)
+        for i, tx_hash in enumerate(tx_hashes, 1) ]
+
+    with MasterKeyTable(db_context) as masterkey_table:
+        with SynchronousWriter() as writer:
+            masterkey_table.create([ MasterKeyRow(MASTERKEY_ID, None, 2, b'111') ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with AccountTable(db_context) as account_table:
+        with SynchronousWriter() as writer:
+            account_table.create([ AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH,
+                'name') ], completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    with TransactionTable(db_context) as transaction_table:
+        with SynchronousWriter() as writer:
+            transaction_table.create(tx_lines, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        assert sorted(tx_hashes) == sorted(row[0] for row in transaction_table.read())
+
+    with KeyInstanceTable(db_context) as keyinstance_table:
+        with SynchronousWriter() as writer:
+            keyinstance_table.create(key_lines, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        assert key_lines == sorted(keyinstance_table.read())
+
+    with TransactionOutputTable(db_context) as txoutput_table:
+        with SynchronousWriter() as writer:
+            txoutput_table.create(txo_lines, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        assert sorted(txo_lines) == sorted(txoutput_table.read())
+
+
+@pytest.mark.timeout(8)
+def test_table_accounts_create_date_created(db_context: DatabaseContext) -> None:
+    line = AccountRow(1, None, ScriptType.P2PKH, 'name1')
+    with AccountTable(db_context) as table:
+        with SynchronousWriter() as writer:
+            table.create([ line ], date_created=1000, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+    db = db_context.acquire_connection()
+    try:
+        cursor = db.execute("SELECT date_created, date_updated FROM Accounts")
+        assert [ (1000, 1000) ] == cursor.fetchall()
+        cursor.close()
+    finally:
+        db_context.release_connection(db)
+
+
 @pytest.mark.timeout(8)
 def test_account_transactions(db_context: DatabaseContext) -> None:
     ACCOUNT_ID_1 = 10
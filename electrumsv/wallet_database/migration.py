@@ -9,6 +9,8 @@ except ModuleNotFoundError:
     import sqlite3 # type: ignore
 
 
+from typing import List, Sequence
+
 from electrumsv.constants import DATABASE_EXT, MIGRATION_CURRENT, MIGRATION_FIRST
 from electrumsv.exceptions import DatabaseMigrationError
 
@@ -89,3 +91,24 @@ def update_database_file(wallet_path: str) -> None:
     db = sqlite3.connect(db_path)
     update_database(db)
     db.close()
+
+
+def drop_indexes(db: sqlite3.Connection, table_names: Sequence[str]) -> List[str]:
+    """
+    Drop the explicitly created indexes on the given tables, so that they are not maintained
+    while the tables are bulk populated. The statements to recreate them are returned.
+    """
+    # Indexes implicitly created for constraints have no SQL and cannot be dropped.
+    cursor = db.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND "
+        "sql IS NOT NULL AND tbl_name IN ({})".format(",".join("?" for t in table_names)),
+        table_names)
+    rows = cursor.fetchall()
+    cursor.close()
+    for index_name, _index_sql in rows:
+        db.execute(f"DROP INDEX {index_name}")
+    return [ index_sql for _index_name, index_sql in rows ]
+
+
+def create_indexes(db: sqlite3.Connection, index_sqls: Sequence[str]) -> None:
+    for index_sql in index_sqls:
+        db.execute(index_sql)
@@ -1,4 +1,5 @@
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
 import queue
 try:
@@ -11,7 +12,7 @@ except ModuleNotFoundError:
 import threading
 import time
 import traceback
-from typing import Any, Callable, List, NamedTuple, Optional, Tuple, Set
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Tuple, Set
 
 from ..constants import DATABASE_EXT
 from ..logs import logs
@@ -79,6 +80,8 @@ class WriteDisabledError(Exception):
     pass
 
 
+# Write callbacks are applied by the dispatcher within an explicit transaction, which may be shared
+# with other queued write callbacks. They must not begin or commit transactions themselves.
 WriteCallbackType = Callable[[sqlite3.Connection], None]
 CompletionCallbackType = Callable[[Optional[Exception]], None]
 class WriteEntryType(NamedTuple):
@@ -106,10 +109,11 @@ class SqliteWriteDispatcher:
         self._logger = logs.get_logger("sqlite-writer")
 
         self._writer_queue: "queue.Queue[WriteEntryType]" = queue.Queue()
-        self._writer_thread = threading.Thread(target=self._writer_thread_main, daemon=True)
+        self._writer_thread = threading.Thread(target=self._writer_thread_main, daemon=True,
+            name="sqlite-writer")
         self._writer_loop_event = threading.Event()
 
-        self._callback_thread_pool = ThreadPoolExecutor()
+        self._callback_thread_pool = ThreadPoolExecutor(thread_name_prefix="sqlite-callback")
 
         self._allow_puts = True
         self._is_alive = True
@@ -152,7 +156,9 @@ class SqliteWriteDispatcher:
             try:
                 with self._db:
                     # We have to force a grouped statement transaction with the explicit 'begin'.
-                    self._db.execute('begin')
+                    # It is immediate so that the write lock is acquired up front, waiting on any
+                    # other writer within the busy timeout, rather than on the first write.
+                    self._db.execute('begin immediate')
                     for write_callback, completion_callback, entry_size_hint in write_entries:
                         write_callback(self._db)
                         if completion_callback is not None:
@@ -230,6 +236,8 @@ class JournalModes(Enum):
 class DatabaseContext:
     MEMORY_PATH = ":memory:"
     JOURNAL_MODE = JournalModes.WAL
+    # Additional pragmas applied to each connection as it is added to the pool.
+    CONNECTION_PRAGMAS: Tuple[str, ...] = ()
 
     SQLITE_CONN_POOL_SIZE = 0
 
@@ -243,6 +251,8 @@ class DatabaseContext:
 
         self._logger = logs.get_logger("sqlite-context")
         self._lock = threading.Lock()
+        # Each thread has its own write group, if it has opened one.
+        self._write_group_state = threading.local()
         self._write_dispatcher = SqliteWriteDispatcher(self)
 
     def acquire_connection(self) -> sqlite3.Connection:
@@ -273,6 +283,11 @@ class DatabaseContext:
         # errors. Perhaps it works now with the locking and backoff retries.
         if not self.is_special_path(self._db_path):
             self._ensure_journal_mode(connection)
+        # These read the schema, so they must not race the journal mode check of other
+        # connections.
+        with self._lock:
+            for pragma in self.CONNECTION_PRAGMAS:
+                connection.execute(pragma)
 
         # self._debug_texts[connection] = debug_text
         self._connection_pool.put(connection)
@@ -326,8 +341,48 @@ class DatabaseContext:
     def queue_write(self, write_callback: WriteCallbackType,
             completion_callback: Optional[CompletionCallbackType]=None,
             size_hint: int=0) -> None:
-        self._write_dispatcher.put(WriteEntryType(write_callback, completion_callback,
-            size_hint))
+        write_entry = WriteEntryType(write_callback, completion_callback, size_hint)
+        write_entries = getattr(self._write_group_state, "entries", None)
+        if write_entries is not None:
+            write_entries.append(write_entry)
+            return
+        self._write_dispatcher.put(write_entry)
+
+    @contextmanager
+    def write_group(self, completion_callback: Optional[CompletionCallbackType]=None) \
+            -> Iterator[None]:
+        """
+        Combine the writes queued by the calling thread within this context into one write, so
+        that they are dispatched together and applied in the same transaction. If the context
+        exits with an exception, the writes are discarded and every completion callback is
+        called with that exception.
+        """
+        assert getattr(self._write_group_state, "entries", None) is None, \
+            "Write groups cannot be nested"
+        write_entries: List[WriteEntryType] = []
+
+        def _completion(exc_value: Optional[Exception]) -> None:
+            for write_entry in write_entries:
+                if write_entry.completion_callback is not None:
+                    write_entry.completion_callback(exc_value)
+            if completion_callback is not None:
+                completion_callback(exc_value)
+
+        self._write_group_state.entries = write_entries
+        try:
+            yield
+        except Exception as exc_value:
+            _completion(exc_value)
+            raise
+        finally:
+            self._write_group_state.entries = None
+
+        def _write(db: sqlite3.Connection) -> None:
+            for write_entry in write_entries:
+                write_entry.write_callback(db)
+
+        self.queue_write(_write, _completion,
+            sum(write_entry.size_hint for write_entry in write_entries))
 
     def close(self) -> None:
         self._write_dispatcher.stop()
@@ -362,6 +417,50 @@ class DatabaseContext:
     def shared_memory_uri(cls, unique_name: str) -> str:
         return f"file:{unique_name}?mode=memory&cache=shared"
 
+
+class MigrationDatabaseContext(DatabaseContext):
+    """
+    The database context used to populate a newly created wallet database with the data from
+    an older wallet file.
+
+    Durability is traded for speed by not syncing writes to disk while they are made. An
+    interrupted migration leaves an incomplete database regardless. Nothing written is known to
+    be on disk until `sync_to_disk` is called, and that must happen before the original wallet
+    file is removed. The pragmas are per-connection and do not outlive this context. The journal
+    mode is left as WAL, as switching it needs exclusive access to the database and the context
+    holds several connections.
+    """
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous=OFF;",
+        "PRAGMA temp_store=MEMORY;",
+        # A negative value is the size in KiB, so this is a 64 MiB page cache.
+        "PRAGMA cache_size=-65536;",
+    )
+
+    def sync_to_disk(self) -> None:
+        """
+        Checkpoint the write-ahead log into the database file with full syncing, so that all
+        the completed writes are on disk. No writes should be pending when this is called.
+        """
+        connection = self.acquire_connection()
+        try:
+            cursor = connection.execute("PRAGMA synchronous;")
+            synchronous = cursor.fetchone()[0]
+            cursor.close()
+            connection.execute("PRAGMA synchronous=FULL;")
+            try:
+                cursor = connection.execute("PRAGMA wal_checkpoint(FULL);")
+                busy, _log_frames, _checkpointed_frames = cursor.fetchone()
+                cursor.close()
+            finally:
+                # The connection goes back to the pool, so it keeps the setting of its peers.
+                connection.execute(f"PRAGMA synchronous={synchronous};")
+        finally:
+            self.release_connection(connection)
+        if busy:
+            raise sqlite3.OperationalError("database checkpoint did not complete")
+
+
 class _QueryCompleter:
     def __init__(self):
         self._event = threading.Event()
@@ -1,4 +1,5 @@
 from io import BytesIO
+from itertools import chain, islice
 import json
 try:
     # Linux expects the latest package version of 3.31.1 (as of p)
@@ -8,7 +9,8 @@ except ModuleNotFoundError:
     # Windows builds use the official Python 3.7.8 builds and version of 3.31.1.
     import sqlite3 # type: ignore
 import time
-from typing import Any, Dict, Iterable, NamedTuple, Optional, List, Sequence, Tuple, Type, TypeVar
+from typing import (Any, Dict, Iterable, Iterator, NamedTuple, Optional, List, Sequence, Tuple,
+    Type, TypeVar)
 
 import bitcoinx
 from bitcoinx import hash_to_hex_str
@@ -50,6 +52,13 @@ class InvalidUpsertError(Exception):
 TXDATA_VERSION = 1
 TXPROOF_VERSION = 1
 
+# The number of rows passed to each `executemany` call when bulk inserting, which bounds the
+# memory used for large writes like the initial wallet migration.
+WRITE_BATCH_SIZE = 10000
+# The most rows inserted by one multi-row `INSERT` statement. Older versions of SQLite implement
+# multi-row `VALUES` as a compound select, which is limited to 500 terms by default.
+MULTIROW_INSERT_LIMIT = 500
+
 
 def byte_repr(value):
     if value is None:
@@ -76,6 +85,29 @@ def collect_results(result_type: Type[T], cursor: sqlite3.Cursor, results: List[
     results.extend(result_type(*row) for row in rows)
 
 
+def batched(iterable: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def create_rows(db: sqlite3.Connection, prefix_sql: str, row_sql: str,
+        rows: Iterable[Sequence[Any]]) -> None:
+    """
+    Insert the rows using multi-row `INSERT` statements, avoiding the per-row statement execution
+    of `executemany`. This is intended for the smaller tables.
+    """
+    batch_size = max(1, min(MULTIROW_INSERT_LIMIT, SQLITE_MAX_VARS // row_sql.count("?")))
+    cursor = db.cursor()
+    for batch in batched(rows, batch_size):
+        query = prefix_sql + ",".join([ row_sql ] * len(batch))
+        cursor.execute(query, list(chain.from_iterable(batch)))
+    cursor.close()
+
+
 def read_rows_by_id(return_type: Type[T], db: sqlite3.Connection, sql: str, params: List[Any], \
         ids: Sequence[int]) -> List[T]:
     results = []
@@ -131,15 +163,16 @@ class WalletDataTable(BaseWalletStore):
     CREATE_SQL = ("INSERT INTO WalletData (key, value, date_created, date_updated) "
         "VALUES (?, ?, ?, ?)")
     READ_SQL = "SELECT key, value FROM WalletData"
+    READ_KEY_SQL = READ_SQL +" WHERE key=?"
     UPDATE_SQL = ("UPDATE WalletData SET value=?, date_updated=? WHERE key=?")
     UPSERT_SQL = (CREATE_SQL +" ON CONFLICT(key) DO UPDATE "
         "SET value=excluded.value, date_updated=excluded.date_updated")
     DELETE_SQL = "DELETE FROM WalletData WHERE key=?"
     DELETE_VALUE_SQL = "DELETE FROM WalletData WHERE key=? AND value=?"
 
-    def create(self, entries: Iterable[WalletDataRow],
+    def create(self, entries: Iterable[WalletDataRow], date_created: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
+        timestamp = self._get_current_timestamp() if date_created is None else date_created
         datas = []
         for entry in entries:
             assert type(entry.key) is str, f"bad key '{entry.key}'"
@@ -153,8 +186,9 @@ class WalletDataTable(BaseWalletStore):
         self._db_context.queue_write(_write, completion_callback)
 
     def get_value(self, key: str) -> Optional[Any]:
-        cursor = self._db.execute(self.READ_SQL +" WHERE key=?", [key])
+        cursor = self._db.execute(self.READ_KEY_SQL, [key])
         row = cursor.fetchone()
+        cursor.close()
         return json.loads(row[1]) if row is not None else None
 
     def read(self, keys: Optional[Sequence[str]]=None) -> List[WalletDataRow]:
@@ -181,7 +215,7 @@ class WalletDataTable(BaseWalletStore):
         return results
 
     def get_row(self, key: str) -> Optional[WalletDataRow]:
-        cursor = self._db.execute(self.READ_SQL +" WHERE key=?", [key])
+        cursor = self._db.execute(self.READ_KEY_SQL, [key])
         row = cursor.fetchone()
         cursor.close()
         if row is not None:
@@ -201,9 +235,9 @@ class WalletDataTable(BaseWalletStore):
 
         self._db_context.queue_write(_write, completion_callback)
 
-    def update(self, entries: Iterable[WalletDataRow],
+    def update(self, entries: Iterable[WalletDataRow], date_updated: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
+        timestamp = self._get_current_timestamp() if date_updated is None else date_updated
         datas = []
         for t in entries:
             datas.append((json.dumps(t.value), timestamp, t.key))
@@ -244,6 +278,16 @@ class TxData(NamedTuple):
 
 MAGIC_UNTOUCHED_BYTEDATA = b''
 
+# The metadata field flags for each combination of present `TxData` fields. This is indexed by
+# `(height is not None) << 2 | (fee is not None) << 1 | (position is not None)`.
+TX_METADATA_FLAGS: Tuple[int, ...] = tuple(
+    (TxFlags.HasHeight.value if index & 4 else 0) |
+    (TxFlags.HasFee.value if index & 2 else 0) |
+    (TxFlags.HasPosition.value if index & 1 else 0) for index in range(8))
+# Plain integer masks avoid the overhead of `IntFlag` operations in the row processing loops.
+TX_METADATA_CLEAR_MASK = ~TxFlags.METADATA_FIELD_MASK.value
+TX_CREATE_CLEAR_MASK = ~(TxFlags.METADATA_FIELD_MASK.value | TxFlags.HasByteData.value)
+
 class TxProof(NamedTuple):
     position: int
     branch: Sequence[bytes]
@@ -283,14 +327,8 @@ class TransactionTable(BaseWalletStore):
 
     @staticmethod
     def _apply_flags(data: TxData, flags: TxFlags) -> TxFlags:
-        flags &= ~TxFlags.METADATA_FIELD_MASK
-        if data.height is not None:
-            flags |= TxFlags.HasHeight
-        if data.fee is not None:
-            flags |= TxFlags.HasFee
-        if data.position is not None:
-            flags |= TxFlags.HasPosition
-        return flags
+        return (flags & TX_METADATA_CLEAR_MASK) | TX_METADATA_FLAGS[(data.height is not None) << 2
+            | (data.fee is not None) << 1 | (data.position is not None)]
 
     @staticmethod
     def _pack_proof(proof: TxProof) -> bytes:
@@ -355,20 +393,28 @@ class TransactionTable(BaseWalletStore):
             CompletionCallbackType]=None) -> None:
         datas = []
         size_hint = 0
+        has_bytedata = TxFlags.HasByteData.value
         for tx_hash, metadata, bytedata, flags, description in entries:
             assert type(tx_hash) is bytes
-            flags &= ~TxFlags.HasByteData
+            # Unpacking the metadata is cheaper than repeated named field access.
+            height, position, fee, date_added, date_updated = metadata
+            # Plain integer operations avoid constructing a new `TxFlags` for each one.
+            flags_value = (int(flags) & TX_CREATE_CLEAR_MASK) | TX_METADATA_FLAGS[
+                (height is not None) << 2 | (fee is not None) << 1 | (position is not None)]
             if bytedata is not None:
-                flags |= TxFlags.HasByteData
+                flags_value |= has_bytedata
                 size_hint += len(bytedata)
-            flags = self._apply_flags(metadata, flags)
-            assert metadata.date_added is not None and metadata.date_updated is not None
-            datas.append((tx_hash, bytedata, flags, metadata.height, metadata.position,
-                metadata.fee, description, metadata.date_added, metadata.date_updated))
+            assert date_added is not None and date_updated is not None
+            datas.append((tx_hash, bytedata, flags_value, height, position, fee, description,
+                date_added, date_updated))
 
         def _write(db: sqlite3.Connection) -> None:
             self._logger.debug("add %d transactions", len(datas))
-            db.executemany(self.CREATE_SQL, datas)
+            # The connection would otherwise create a new cursor for each batch.
+            cursor = db.cursor()
+            for batch in batched(datas, WRITE_BATCH_SIZE):
+                cursor.executemany(self.CREATE_SQL, batch)
+            cursor.close()
         self._db_context.queue_write(_write, completion_callback, size_hint)
 
     def read(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
@@ -504,20 +550,21 @@ class MasterKeyRow(NamedTuple):
 class MasterKeyTable(BaseWalletStore):
     LOGGER_NAME = "db-table-masterkey"
 
-    CREATE_SQL = ("INSERT INTO MasterKeys (masterkey_id, parent_masterkey_id, derivation_type, "
-        "derivation_data, date_created, date_updated) VALUES (?, ?, ?, ?, ?, ?)")
+    CREATE_PREFIX_SQL = ("INSERT INTO MasterKeys (masterkey_id, parent_masterkey_id, "
+        "derivation_type, derivation_data, date_created, date_updated) VALUES ")
+    CREATE_ROW_SQL = "(?, ?, ?, ?, ?, ?)"
     READ_SQL = ("SELECT masterkey_id, parent_masterkey_id, derivation_type, derivation_data "
         "FROM MasterKeys")
     UPDATE_SQL = "UPDATE MasterKeys SET derivation_data=?, date_updated=? WHERE masterkey_id=?"
     DELETE_SQL = "DELETE FROM MasterKeys WHERE masterkey_id=?"
 
-    def create(self, entries: Iterable[MasterKeyRow],
+    def create(self, entries: Sequence[MasterKeyRow], date_created: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
-        datas = [ (*t, timestamp, timestamp) for t in entries ]
+        timestamp = self._get_current_timestamp() if date_created is None else date_created
         size_hint = sum(len(t[3]) for t in entries)
         def _write(db: sqlite3.Connection):
-            db.executemany(self.CREATE_SQL, datas)
+            create_rows(db, self.CREATE_PREFIX_SQL, self.CREATE_ROW_SQL,
+                ((t[0], t[1], int(t[2]), t[3], timestamp, timestamp) for t in entries))
         self._db_context.queue_write(_write, completion_callback, size_hint)
 
     def read(self) -> List[MasterKeyRow]:
@@ -558,8 +605,9 @@ class AccountRow(NamedTuple):
 class AccountTable(BaseWalletStore):
     LOGGER_NAME = "db-table-account"
 
-    CREATE_SQL = ("INSERT INTO Accounts (account_id, default_masterkey_id, default_script_type, "
-        "account_name, date_created, date_updated) VALUES (?, ?, ?, ?, ?, ?)")
+    CREATE_PREFIX_SQL = ("INSERT INTO Accounts (account_id, default_masterkey_id, "
+        "default_script_type, account_name, date_created, date_updated) VALUES ")
+    CREATE_ROW_SQL = "(?, ?, ?, ?, ?, ?)"
     READ_SQL = ("SELECT account_id, default_masterkey_id, default_script_type, account_name "
         "FROM Accounts")
     UPDATE_MASTERKEY_SQL = ("UPDATE Accounts SET date_updated=?, default_masterkey_id=?, "
@@ -570,12 +618,12 @@ class AccountTable(BaseWalletStore):
         "WHERE account_id=?")
     DELETE_SQL = "DELETE FROM Accounts WHERE account_id=?"
 
-    def create(self, entries: Iterable[AccountRow],
+    def create(self, entries: Sequence[AccountRow], date_created: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
-        datas = [ (*t, timestamp, timestamp) for t in entries ]
+        timestamp = self._get_current_timestamp() if date_created is None else date_created
         def _write(db: sqlite3.Connection):
-            db.executemany(self.CREATE_SQL, datas)
+            create_rows(db, self.CREATE_PREFIX_SQL, self.CREATE_ROW_SQL,
+                ((t[0], t[1], int(t[2]), t[3], timestamp, timestamp) for t in entries))
         self._db_context.queue_write(_write, completion_callback)
 
     def read(self) -> List[AccountRow]:
@@ -656,13 +704,18 @@ class KeyInstanceTable(BaseWalletStore):
 
     DELETE_SQL = "DELETE FROM KeyInstances WHERE keyinstance_id=?"
 
-    def create(self, entries: Iterable[KeyInstanceRow],
+    def create(self, entries: Sequence[KeyInstanceRow], date_created: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
-        datas = [ (*t, timestamp, timestamp) for t in entries]
+        timestamp = self._get_current_timestamp() if date_created is None else date_created
         size_hint = sum(len(t[4]) for t in entries)
         def _write(db: sqlite3.Connection):
-            db.executemany(self.CREATE_SQL, datas)
+            # The rows are generated here as a failed batch of writes may call this again.
+            datas = ((t[0], t[1], t[2], int(t[3]), t[4], int(t[5]), int(t[6]), t[7], timestamp,
+                timestamp) for t in entries)
+            cursor = db.cursor()
+            for batch in batched(datas, WRITE_BATCH_SIZE):
+                cursor.executemany(self.CREATE_SQL, batch)
+            cursor.close()
         self._db_context.queue_write(_write, completion_callback, size_hint)
 
     # We cannot take Sequence in place of List, because Sequences are not addable.
@@ -765,12 +818,17 @@ class TransactionOutputTable(BaseWalletStore):
     DELETE_SQL = "DELETE FROM TransactionOutputs WHERE tx_hash=? AND tx_index=?"
     DELETE_TRANSACTION_SQL = "DELETE FROM TransactionOutputs WHERE tx_hash=?"
 
-    def create(self, entries: Iterable[TransactionOutputRow],
+    def create(self, entries: Sequence[TransactionOutputRow], date_created: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
-        datas = [ (*t, timestamp, timestamp) for t in entries ]
+        timestamp = self._get_current_timestamp() if date_created is None else date_created
         def _write(db: sqlite3.Connection):
-            db.executemany(self.CREATE_SQL, datas)
+            # The rows are generated here as a failed batch of writes may call this again.
+            datas = ((t[0], t[1], t[2], t[3], int(t[4]), timestamp, timestamp)
+                for t in entries)
+            cursor = db.cursor()
+            for batch in batched(datas, WRITE_BATCH_SIZE):
+                cursor.executemany(self.CREATE_SQL, batch)
+            cursor.close()
         self._db_context.queue_write(_write, completion_callback)
 
     # We cannot take Sequence in place of List, because Sequences are not addable.
@@ -1026,12 +1084,11 @@ class TransactionDeltaTable(BaseWalletStore):
 
         return key_ids
 
-    def create(self, entries: Iterable[TransactionDeltaRow],
+    def create(self, entries: Sequence[TransactionDeltaRow], date_created: Optional[int]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        timestamp = self._get_current_timestamp()
-        datas = [ (*t, timestamp, timestamp) for t in entries ]
+        timestamp = self._get_current_timestamp() if date_created is None else date_created
         def _write(db: sqlite3.Connection):
-            db.executemany(self.CREATE_SQL, datas)
+            db.executemany(self.CREATE_SQL, ((*t, timestamp, timestamp) for t in entries))
         self._db_context.queue_write(_write, completion_callback)
 
     def create_or_update_relative_values(self, entries: Iterable[TransactionDeltaRow],
@@ -1149,9 +1206,10 @@ class PaymentRequestRow(NamedTuple):
 class PaymentRequestTable(BaseWalletStore):
     LOGGER_NAME = "db-table-prequest"
 
-    CREATE_SQL = ("INSERT INTO PaymentRequests "
+    CREATE_PREFIX_SQL = ("INSERT INTO PaymentRequests "
         "(paymentrequest_id, keyinstance_id, state, value, expiration, description, date_created, "
-        "date_updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+        "date_updated) VALUES ")
+    CREATE_ROW_SQL = "(?, ?, ?, ?, ?, ?, ?, ?)"
     READ_ALL_SQL = ("SELECT P.paymentrequest_id, P.keyinstance_id, P.state, P.value, P.expiration, "
         "P.description, P.date_created FROM PaymentRequests P")
     READ_ACCOUNT_SQL = (READ_ALL_SQL +" INNER JOIN KeyInstances K USING(keyinstance_id) "
@@ -1162,12 +1220,12 @@ class PaymentRequestTable(BaseWalletStore):
         state=(state&{~PaymentFlag.STATE_MASK})|? WHERE keyinstance_id=?""")
     DELETE_SQL = "DELETE FROM PaymentRequests WHERE paymentrequest_id=?"
 
-    def create(self, entries: Iterable[PaymentRequestRow],
+    def create(self, entries: Sequence[PaymentRequestRow],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        # Duplicate the last column for date_updated = date_created
-        datas = [ (*t, t[-1]) for t in entries ]
         def _write(db: sqlite3.Connection):
-            db.executemany(self.CREATE_SQL, datas)
+            # Duplicate the last column for date_updated = date_created
+            create_rows(db, self.CREATE_PREFIX_SQL, self.CREATE_ROW_SQL,
+                ((t[0], t[1], int(t[2]), t[3], t[4], t[5], t[6], t[6]) for t in entries))
         self._db_context.queue_write(_write, completion_callback)
 
     def read_one(self, request_id: Optional[int]=None, keyinstance_id: Optional[int]=None) \